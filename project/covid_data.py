@@ -2,30 +2,26 @@
 by Keelin Becker-Wheeler, Apr 2020
 """
 
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from matplotlib.collections import PatchCollection
 from bisect import bisect
 
-import matplotlib.colors as plt_colors
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
 import datetime
-import cv2
-import os
 
-from .world_shapes import create_world_map, get_location_to_shape_mapping, get_drawable_patches
-from .utils.progress_tracker import ProgressTracker
+from .world_shapes import find_unmatched_locations, resolve_location_fixes, shape_levels
+from .render_context import RenderContext
 
-##############################
-# Uncomment if manually debugging location fixes
-
-# from .world_shapes import search_for_location_fix
-# import sys
-##############################
+# Note: pandas and numpy are imported where needed to keep startup fast
 
 
 class CovidDataset:
+    """
+    The covid data, grouped by date and location, with the totals of every location at each level precomputed.
+    It is not changed after loading, so several render contexts can draw from one dataset, see RenderContext.
+    Note that pandas may still build lookup tables lazily on the first read of a table, so reading from several
+    threads at once relies on pandas tolerating that.
+    """
+
+    # Data columns which are counts, and so can be summed into totals for larger locations
+    targets = ['Confirmed', 'Deaths']
 
     # Mapping of location names to corrected standard location names are provided for each granularity level
     # Necessary due to mismatch between location names in covid dataset and standard location names
@@ -86,6 +82,9 @@ class CovidDataset:
         :type usa_file: str, path object or file-like object
         """
 
+        import pandas as pd
+        import numpy as np
+
         # Desired names of data columns
         col_names = ['Admin0', 'Admin1', 'Admin2', 'Latitude', 'Longitude', 'Date', 'Confirmed', 'Deaths']
 
@@ -121,15 +120,16 @@ class CovidDataset:
         all_dates, _, _, _ = zip(*list(self.data.index))
         self.all_dates = sorted(list(set(all_dates)))
 
+        self.build_rollups()
         self.find_reversed_location_fixes()
-        self.world = None
 
     def get_datapoints(self, locations=None, date=None, level=0, target='Confirmed'):
         """
-        :param locations: A list of location names to get data for. Will use all locations if None, defaults to None
+        :param locations: A list of location names to get data for. Will use all locations which appear at any date
+                          if None, defaults to None. Locations without data at the date have a value of 0
         :param date: Timestamp at which to get data. Will use current time if None, defaults to None
         :param level: Granularity of world data, higher is more detail. Either 0, 1 or 2, defaults to 0
-        :param target: The target column to get data from, defaults to 'Confirmed'
+        :param target: The target column to get data from. Either 'Confirmed' or 'Deaths', defaults to 'Confirmed'
 
         :type locations: [str]|None, optional
         :type date: datetime.datetime|None, optional
@@ -139,12 +139,15 @@ class CovidDataset:
         :returns: The data corresponding to the given parameters
         :rtype: pd.DataFrame
 
-        :raises: ValueError
+        :raises: ValueError: If level is not 0, 1 or 2, or target is not one of CovidDataset.targets
         """
 
         if level not in [0, 1, 2]:
             raise ValueError(f'unexpected level={level}')
 
+        if target not in self.targets:
+            raise ValueError(f'unexpected target={target}')
+
         if date is None:
             # Use current timestamp if not provided
             date = datetime.datetime.now()
@@ -153,19 +156,38 @@ class CovidDataset:
         date = self.get_closest_previous_date(date)
 
         if locations is None:
-            Admin = tuple(zip(*list(self.data.loc[date].index)))
-            locations = sorted(list(set(Admin[level])))
-
-        data_dict = {}
-        for location in locations:
-            if location:
-                datapoint = self.data.loc[date].query(f'Admin{level} == "{location}"')[target].sum()
-                data_dict[location] = datapoint
+            locations = self.locations[level]
 
-        df = pd.DataFrame(data=data_dict, index=[0]).transpose()
-        df.rename(columns={0: target}, inplace=True)
+        # Look up the precomputed totals, where locations without data at the date have a total of 0
+        totals = self.rollups[level][target].loc[date]
+        df = totals.reindex([location for location in locations if location], fill_value=0).to_frame(target)
+        df.index.name = None
         return df
 
+    def build_rollups(self):
+        """ Precomputes the totals of every location at every level and date, and the registry of all location names.
+
+        Admin2 rows are summed into Admin1 totals, which are summed into Admin0 totals, in a single pass.
+        Locations are identified by name alone at each level, so the rollups match summing all rows with that name.
+        """
+
+        rows = self.data[self.targets]
+
+        self.rollups = {}
+        self.locations = {}
+
+        for level in [2, 1, 0]:
+            # Sum the rows of the level below into rows of this level, keeping the names of the parent locations
+            rows = rows.groupby(level=['Date'] + [f'Admin{lvl}' for lvl in range(level+1)]).sum()
+            totals = rows.groupby(level=['Date', f'Admin{level}']).sum()
+
+            # Tables of dates by location names, with 0 for locations which have no data (yet) at a date
+            self.rollups[level] = {target: totals[target].unstack(fill_value=0) for target in self.targets}
+
+            # Every location which appears at any date, except for the empty name of unknown locations
+            self.locations[level] = sorted(location for location in self.rollups[level][self.targets[0]].columns
+                                           if location)
+
     def find_reversed_location_fixes(self):
         """ Create reversed location fix mapping
         """
@@ -191,203 +213,105 @@ class CovidDataset:
             idx = 0
         return self.all_dates[idx]
 
-    def determine_world_mapping(self):
-        """Draws a world map and adds a 'pos' field to data which encodes the (x,y) world position.
-
-        :returns: Map figure on which geographical data can be drawn
-        :rtype: matplotlib.figure.Figure
+    def get_locations(self, level):
         """
+        :param level: Granularity of world data, higher is more detail. Either 0, 1 or 2
+
+        :type level: int
+
+        :returns: The unique names of locations at the given level, across all dates
+        :rtype: [str]
 
-        fig = plt.figure()
-        ax = fig.gca()
+        :raises: ValueError
+        """
 
-        self.world = create_world_map(ax, fill_color=False, draw_borders=False)
+        if level not in [0, 1, 2]:
+            raise ValueError(f'unexpected level={level}')
 
-        # Use map projection to convert long/lat into (x,y) positions
-        self.data['pos'] = list(zip(*self.world(list(self.data.Longitude), list(self.data.Latitude))))
+        return self.locations[level]
 
-        return fig
+    def plot_data_over_time(self, shape_folder='.', level=0, filename='covid_visualization.avi', overwrite=False,
+                            region=None, skip_unchanged=True, date_step=1, max_change=None, frames_per_key=None, fps=5):
+        """ Convenience wrapper around RenderContext.plot_data_over_time
 
-    def plot_data_over_time(self, shape_folder='.', level=0, filename='covid_visualization.avi', overwrite=False):
-        """
         :param shape_folder: Folder in which shape files exist, defaults to '.'
         :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
         :param filename: File to save video to, defaults to 'covid_visualization.avi'.
         :param overwrite: If True will overwrite existing file, defaults to False.
+        :param region: A name from world_shapes.regions, or a (min lon, min lat, max lon, max lat) tuple.
+                       Will use the whole world if None, defaults to None
+        :param skip_unchanged: If True will reuse the previous render, with only its title redrawn,
+                               for key dates whose plotted colors match the previous key date, defaults to True
+        :param date_step: Every Nth date is a key date, which is fully rendered. The frames in between are blended
+                          from the key dates on either side, both drawn on the color scale of the later one,
+                          defaults to 1
+        :param max_change: If given, any date where some location changed by at least this much since the last key date,
+                           in orders of magnitude (e.g. 0.5), is also a key date, defaults to None
+        :param frames_per_key: Number of video frames from one key date to the next, the last of which is the
+                               next key date. Each frame is titled with the nearest date, so dates repeat if there are
+                               more frames than dates. Will use one frame per date if None, defaults to None
+        :param fps: Frame rate of the video, defaults to 5
 
         :type shape_folder: str, optional
         :type level: int, optional
         :type filename: str, optional
         :type overwrite: bool, optional
+        :type region: str|(float, float, float, float)|None, optional
+        :type skip_unchanged: bool, optional
+        :type date_step: int, optional
+        :type max_change: float|None, optional
+        :type frames_per_key: int|None, optional
+        :type fps: float, optional
 
         :returns: Filename of video file written.
         :rtype: str
         """
 
-        if (not overwrite) and os.path.exists(filename):
-            return filename
-
-        video_writer = None
-        admin = None
-        w = 16
-        h = 12
-        dpi = 100
-
-        with ProgressTracker('iterating dates') as progress:
-            for date in self.all_dates:
-                plotted_data, fig = self.plot_data_as_world_colors(date=date, shape_folder=shape_folder, level=level)
-                fig.suptitle(f'Confirmed Cases - {date.date()}', y=0.73)
-                fig.set_size_inches(w, h)
-
-                if admin is None:
-                    admin = plotted_data[level].index
-                else:
-                    # Sanity check that all countries are accounted for
-                    assert((admin == plotted_data[level].index).all())
-
-                # Create image from figure
-                fig.canvas.draw()
-                img = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep='')
-                img = img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                img = img[int(dpi*h*.25):int(dpi*h*.75), int(dpi*w*.05):int(dpi*w*.95)]
-
-                plt.close(fig)
-                self.reset_world()
-
-                if video_writer is None:
-                    height, width, _ = img.shape
-                    size = (width, height)
-
-                    video_writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'DIVX'), 5, size)
-
-                video_writer.write(img)
+        context = RenderContext(self, shape_folder=shape_folder, region=region)
+        return context.plot_data_over_time(level=level, filename=filename, overwrite=overwrite,
+                                           skip_unchanged=skip_unchanged, date_step=date_step, max_change=max_change,
+                                           frames_per_key=frames_per_key, fps=fps)
 
-                progress.add(1, maximum=len(self.all_dates))
+    def plot_data_as_world_colors(self, date=None, shape_folder='.', level=0, region=None):
+        """ Convenience wrapper around RenderContext.plot_data_as_world_colors
 
-        video_writer.release()
-        return filename
-
-    def plot_data_as_world_colors(self, date=None, shape_folder='.', level=0):
-        """
         :param date: Timestamp at which to plot data. Will use current time if None, defaults to None
         :param shape_folder: Folder in which shape files exist, defaults to '.'
         :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
+        :param region: A name from world_shapes.regions, or a (min lon, min lat, max lon, max lat) tuple.
+                       Shapes and data locations outside the region are skipped. Will use the whole world if None,
+                       defaults to None
 
         :type date: datetime.datetime|None, optional
         :type shape_folder: str, optional
         :type level: int, optional
+        :type region: str|(float, float, float, float)|None, optional
 
         :returns: A dictionary mapping levels to the plotted data at that level of granularity
-                  and the map figure on which geographical data was drawn
+                  and a new map figure on which geographical data was drawn
         :rtype: ({int:pd.DataFrame}, matplotlib.figure.Figure)
         """
 
-        if self.world is None:
-            # Generate empty world if not already exists
-            fig = self.determine_world_mapping()
-        else:
-            fig = plt.gcf()
-
-        ax = fig.gca()
-        ax.set_facecolor("#5D9BFF")
-
-        ##############################
-        # If you need to manually check all location fix possibilities for a given location, uncomment the following:
-
-        # debug_location = 'Nunavut'
-        # self.load_shape_info_at_level(level, shape_folder=shape_folder)
-        # search_for_location_fix(self.world, debug_location, None)
-        # sys.exit(0)
-
-        # You may also let the program search for and automatically print potential location fixes by setting the following
-        debug_new_location_fixes = False
-        ##############################
-
-        maximum = 0
-        colors = None
-
-        plotted_data_per_level = {}
-
-        # Work up to highest granularity
-        for lvl in range(level+1):
-            locations, info_keys = self.load_shape_info_at_level(lvl, shape_folder=shape_folder)
-
-            shape_map, empty_patches = get_location_to_shape_mapping(self.world, locations, info_keys, self.rev_location_fixes)
-            patches = get_drawable_patches(self.world, locations, shape_map, info_keys, self.location_fixes,
-                                           debug_new_location_fixes=debug_new_location_fixes)
-
-            # Track what data is being plotted
-            plotted_data_per_level[lvl] = self.get_datapoints(locations=patches.keys(), date=date, level=lvl)
-
-            if lvl == 0:
-                # Store the polygons of locations which do not correspond with data
-                patches[None] = empty_patches
-
-                maximum = plotted_data_per_level[lvl].max()
-
-                # Set up a colormap with logarithmic scale
-                colors = plt.cm.ScalarMappable(norm=plt_colors.LogNorm(vmin=1, vmax=maximum), cmap='Reds')
-                colors.get_cmap().set_bad(colors.get_cmap()(0))
-
-            # Draw shapes with color according to associated location data
-            for k, v in patches.items():
-                if v:
-                    if k is None:
-                        # Color unknown locations black
-                        facecolor = 'k'
-                        zorder = 2  # Make sure unknown locations are drawn behind known locations, in case of overlap
-
-                    else:
-                        # Change color based on data value
-                        value = plotted_data_per_level[lvl].loc[k]
-                        facecolor = colors.to_rgba(value)
-                        zorder = 3 + lvl  # Make sure higher granularity is on top
+        context = RenderContext(self, shape_folder=shape_folder, region=region)
+        return context.plot_data_as_world_colors(date=date, level=level)
 
-                    ax.add_collection(PatchCollection(v, facecolor=facecolor, edgecolor='k', linewidths=0.2, zorder=zorder))
+    def propose_location_fixes(self, shape_folder='.', level=0):
+        """ Finds all data locations at the given level without a matching shape, and proposes a fix for each in one pass.
 
-        divider = make_axes_locatable(ax)
-        cax = divider.append_axes("right", size="5%", pad=0.02)
-        fig.colorbar(colors, cax=cax)
-
-        return plotted_data_per_level, fig
-
-    def load_shape_info_at_level(self, level, shape_folder='.'):
-        """
-        :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
         :param shape_folder: Folder in which shape files exist, defaults to '.'
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
 
-        :type level: int
         :type shape_folder: str, optional
+        :type level: int, optional
 
-        :returns: A list of locations at the given level, a list of keys used to get the location from the shape info data
-        :rtype: ([str], [str])
-
-        :raises: ValueError
+        :returns: A proposed location fix table, mapping each unmatched location to a shape info location name or None
+        :rtype: {str:str}
         """
 
-        # Get unique names of locations
-        Admin0, Admin1, _ = zip(*list(self.data.loc[self.all_dates[0]].index))
-
-        if level == 0:
-            locations = sorted(list(set(Admin0)))
-            shape_file = 'ne_10m_admin_0_countries'
-            info_keys = ['NAME_SORT', 'SOVEREIGNT']
-
-        elif level == 1:
-            locations = sorted(list(set(Admin1)))
-            shape_file = 'ne_10m_admin_1_states_provinces'
-            info_keys = ['name', 'admin']
-
-        else:
-            raise ValueError(f'unexpected level={level}')
-
-        self.world.readshapefile(f'{shape_folder}/{shape_file}', 'shapes', drawbounds=False)
+        _, info_keys = shape_levels[level]
+        layer = RenderContext(self, shape_folder=shape_folder).get_layer(level)
 
-        return locations, info_keys
-
-    def reset_world(self):
-        """ Clears the world data associated with the dataset.
-        """
+        shape_names = set(info[info_key] for info in layer.shapes_info for info_key in info_keys)
+        unmatched = find_unmatched_locations(self.get_locations(level), shape_names, self.location_fixes)
 
-        self.world = None
+        return resolve_location_fixes(layer, unmatched, info_keys, index=layer.get_info_index())
@@ -10,23 +10,49 @@ import argparse
 import time
 import sys
 
-from .covid_data import CovidDataset
 from .utils.benchmark import benchmark_timing
-from .prediction import plot_chart_and_table
+from .world_shapes import get_region_bounds, regions
 
 
 def main(args):
+    # Heavy modules are only imported once there is work to do, so `-h` stays fast
+    from .covid_data import CovidDataset
+    from .prediction import plot_chart_and_table
+
     dataset = benchmark_timing('Reading dataset', CovidDataset, args.world_data, args.usa_data)
+
+    if args.propose_location_fixes:
+        from .world_shapes import print_location_fixes
+
+        # Print a proposed location_fixes table for every level up to the requested one, then stop
+        for level in range(args.level+1):
+            fixes = benchmark_timing(f'Proposing level {level} location fixes', dataset.propose_location_fixes,
+                                     shape_folder=args.shapefiles, level=level)
+            print_location_fixes(fixes)
+        return
+
+    if args.bbox is not None:
+        region = tuple(args.bbox)
+        region_suffix = '_' + '_'.join(f'{n:g}' for n in args.bbox)
+    else:
+        region = args.region
+        region_suffix = '' if args.region is None else f'_{args.region}'
+
     video_file = benchmark_timing('Visualizing data', dataset.plot_data_over_time,
-                                  shape_folder=args.shapefiles, level=args.level,
-                                  filename=f'covid_visualization_{args.level}.avi')
+                                  shape_folder=args.shapefiles, level=args.level, region=region,
+                                  skip_unchanged=not args.render_all_frames,
+                                  date_step=args.date_step, max_change=args.max_change,
+                                  frames_per_key=args.frames_per_key, fps=args.fps,
+                                  filename=f'covid_visualization_{args.level}{region_suffix}.avi')
 
     print(f'Visualization created at: {video_file}')
 
     # plot top 10 countries confirmed with COVID-19
     # confirmed VS deaths
     # predict confirmed cases after 5 days
-    plot_chart_and_table(dataset)
+    chart_file = plot_chart_and_table(dataset)
+
+    print(f'Prediction chart created at: {chart_file}')
 
 
 if __name__ == '__main__':
@@ -41,8 +67,32 @@ if __name__ == '__main__':
     _parser.add_argument('--usa-data', default='covid-19-data/data/us.csv', help='')
     _parser.add_argument('--shapefiles', default='shapefiles', help='')
     _parser.add_argument('--level', default=0, type=int, help='')
+    _region_group = _parser.add_mutually_exclusive_group()
+    _region_group.add_argument('--region', default=None, choices=sorted(regions), help='named region to render')
+    _region_group.add_argument('--bbox', default=None, nargs=4, type=float,
+                               metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'), help='map extent to render')
+    _parser.add_argument('--render-all-frames', action='store_true',
+                         help='fully render every date, even when its colors match the previous date')
+    _parser.add_argument('--date-step', default=1, type=int,
+                         help='only fully render every Nth date, blending the frames in between')
+    _parser.add_argument('--max-change', default=None, type=float,
+                         help='also fully render any date where a location changed by this many orders of magnitude')
+    _parser.add_argument('--frames-per-key', default=None, type=int,
+                         help='number of video frames from one fully rendered date to the next (default: one per date)')
+    _parser.add_argument('--fps', default=5, type=float, help='frame rate of the video')
+    _parser.add_argument('--propose-location-fixes', action='store_true',
+                         help='print proposed location_fixes entries for unmatched data locations, then exit')
     _args = _parser.parse_args()
 
+    if _args.bbox is not None:
+        try:
+            get_region_bounds(tuple(_args.bbox))
+        except ValueError:
+            _parser.error('--bbox must satisfy -180 <= MIN_LON < MAX_LON <= 180 and -90 <= MIN_LAT < MAX_LAT <= 90')
+
+    if _args.date_step < 1 or (_args.frames_per_key is not None and _args.frames_per_key < 1):
+        _parser.error('--date-step and --frames-per-key must be at least 1')
+
     # Track runtime
     _main_start = time.time()
     main(_args)
@@ -7,16 +7,19 @@ by Yiwen Ma, Apr 2020
 """
 
 from .utils.progress_tracker import ProgressTracker
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
+from .utils.headless import import_pyplot
 
 
 def test(self):
     print(self)
 
 
-def plot_chart_and_table(dataset):
+def plot_chart_and_table(dataset, filename='covid_prediction.png'):
+    # defer heavy imports until a chart is actually requested
+    plt = import_pyplot()
+    import pandas as pd
+    import numpy as np
+
     # Create a new dataset:
     confirmed = dataset.get_datapoints()
     deaths = dataset.get_datapoints(target='Deaths')
@@ -95,7 +98,11 @@ def plot_chart_and_table(dataset):
     ax2.set_ylabel('ratio', fontweight='bold')
     plt.title('Top 10 Countries Confirmed Cases (COVID-19) w/ Predication')
 
-    # Create legend & Show graphic
+    # Create legend & Save graphic (rendering is headless, so the chart cannot be shown interactively)
     ax.legend(loc=0)
     plt.legend(loc='upper left')
-    plt.show()
+    fig.set_size_inches(16, 9)
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+
+    return filename
@@ -0,0 +1,597 @@
+"""
+by Keelin Becker-Wheeler, Apr 2020
+"""
+
+import threading
+import os
+
+from .world_shapes import create_world_map, draw_world_map, get_location_to_shape_mapping, get_drawable_patches, \
+    get_region_bounds, get_map_viewport, ShapeBoundsIndex, ShapeLayer, shape_levels
+from .utils.progress_tracker import ProgressTracker
+
+# Note: numpy, cv2 and matplotlib are imported where needed to keep startup fast
+
+##############################
+# Uncomment if manually debugging location fixes
+
+# from .world_shapes import search_for_location_fix
+# import sys
+##############################
+
+
+class RenderContext:
+    """
+    Owns everything needed to draw a dataset on a map of one region: the map projection, the shape geometry
+    and the figures it draws on. Figures are created without pyplot, so contexts do not share any pyplot state,
+    and they only read from the dataset they draw.
+    """
+
+    def __init__(self, dataset, shape_folder='.', region=None, size=(16, 12), dpi=100):
+        """
+        :param dataset: The data to draw, which is only read from
+        :param shape_folder: Folder in which shape files exist, defaults to '.'
+        :param region: A name from world_shapes.regions, or a (min lon, min lat, max lon, max lat) tuple.
+                       Shapes and data locations outside the region are skipped. Will use the whole world if None,
+                       defaults to None
+        :param size: The (width, height) of drawn figures in inches, defaults to (16, 12)
+        :param dpi: Resolution of drawn figures in dots per inch, defaults to 100
+
+        :type dataset: CovidDataset
+        :type shape_folder: str, optional
+        :type region: str|(float, float, float, float)|None, optional
+        :type size: (float, float), optional
+        :type dpi: int, optional
+        """
+
+        self.dataset = dataset
+        self.shape_folder = shape_folder
+        self.bounds = get_region_bounds(region)
+        self.size = size
+        self.dpi = dpi
+
+        # The map projection, which is shared by every figure drawn by this context
+        self.world = create_world_map(None, fill_color=False, draw_borders=False, bounds=self.bounds)
+
+        # Shape geometry and visible shapes for each level, loaded once on first use
+        self.layers = {}
+        self.visible_shapes = {}
+        self.lock = threading.Lock()
+
+    def get_layer(self, level):
+        """
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1
+
+        :type level: int
+
+        :returns: The shapes at the given level, projected onto the map
+        :rtype: ShapeLayer
+
+        :raises: ValueError
+        """
+
+        if level not in shape_levels:
+            raise ValueError(f'unexpected level={level}')
+
+        with self.lock:
+            if level not in self.layers:
+                shape_file, _ = shape_levels[level]
+                self.layers[level] = ShapeLayer(self.world, f'{self.shape_folder}/{shape_file}')
+
+            return self.layers[level]
+
+    def get_visible_shapes(self, level):
+        """
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1
+
+        :type level: int
+
+        :returns: Indices of the shapes at the given level inside the map region, or None if the map shows the whole world
+        :rtype: {int}|None
+        """
+
+        if self.bounds == get_region_bounds():
+            return None
+
+        layer = self.get_layer(level)
+
+        with self.lock:
+            if level not in self.visible_shapes:
+                # The viewport is fixed for the context, so the shapes inside it only need to be found once
+                self.visible_shapes[level] = ShapeBoundsIndex(layer.shapes).query(get_map_viewport(self.world))
+
+            return self.visible_shapes[level]
+
+    def create_figure(self):
+        """
+        :returns: A new figure, not managed by pyplot, with an empty map drawn on its axes
+        :rtype: matplotlib.figure.Figure
+        """
+
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=self.size, dpi=self.dpi)
+        FigureCanvasAgg(fig)
+
+        ax = fig.add_subplot(111)
+        draw_world_map(self.world, ax, fill_color=False, draw_borders=False)
+
+        return fig
+
+    def plot_data_over_time(self, level=0, filename='covid_visualization.avi', overwrite=False, skip_unchanged=True,
+                            date_step=1, max_change=None, frames_per_key=None, fps=5):
+        """ Renders the map at key dates only, so fewer key dates mean fewer full renders. The video frames in between
+        cross-fade from the previous key date to the next, both drawn on the color scale of the next key date.
+
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
+        :param filename: File to save video to, defaults to 'covid_visualization.avi'.
+        :param overwrite: If True will overwrite existing file, defaults to False.
+        :param skip_unchanged: If True will reuse the previous render, with only its title redrawn,
+                               when the plotted colors match the previous render, defaults to True
+        :param date_step: Every Nth date is a key date, defaults to 1
+        :param max_change: If given, any date where some location changed by at least this much since the last key date,
+                           in orders of magnitude (e.g. 0.5), is also a key date, defaults to None
+        :param frames_per_key: Number of video frames from one key date to the next, the last of which is the
+                               next key date. Each frame is titled with the nearest date, so dates repeat if there are
+                               more frames than dates. Will use one frame per date if None, defaults to None
+        :param fps: Frame rate of the video, defaults to 5
+
+        :type level: int, optional
+        :type filename: str, optional
+        :type overwrite: bool, optional
+        :type skip_unchanged: bool, optional
+        :type date_step: int, optional
+        :type max_change: float|None, optional
+        :type frames_per_key: int|None, optional
+        :type fps: float, optional
+
+        :returns: Filename of video file written.
+        :rtype: str
+
+        :raises: ValueError
+        """
+
+        if frames_per_key is not None and frames_per_key < 1:
+            raise ValueError(f'unexpected frames_per_key={frames_per_key}')
+
+        if (not overwrite) and os.path.exists(filename):
+            return filename
+
+        import cv2
+
+        all_dates = self.dataset.all_dates
+
+        video_writer = None
+        crop = None
+        title_strip = None
+
+        # The map and its shapes are only built once, then recolored for each key date
+        frame = self.draw_frame(date=all_dates[0], level=level)
+        fig = frame.figure
+        ax = fig.axes[0]
+
+        plotted_locations = {lvl: data.index for lvl, data in frame.plotted_data.items()}
+        key_values = self.get_key_values(plotted_locations, date_step=date_step, max_change=max_change)
+        key_indices = sorted(key_values)
+
+        background = None
+        last_signature = None
+        rendered = 0
+        rescaled = 0
+        written = 0
+
+        with ProgressTracker('iterating key dates') as progress:
+            for k, key in enumerate(key_indices):
+                previous = key_indices[k-1] if k > 0 else key
+                steps = key-previous if frames_per_key is None else frames_per_key
+
+                # Frames between two key dates are blended from both key dates drawn on the color scale of the later one,
+                # so the colorbar stays the same and locations whose value is unchanged keep their exact color
+                maximum = key_values[key][0].max()
+                renders = [previous, key] if k > 0 and steps > 1 else [key]
+                images = []
+
+                for index in renders:
+                    signature = self.get_frame_signature(key_values[index], maximum)
+
+                    if skip_unchanged and signature == last_signature:
+                        # Same colors as the previous render, so restore its rendered map and only redraw the title
+                        fig.canvas.restore_region(background)
+
+                    else:
+                        frame.recolor(key_values[index], maximum)
+
+                        # Render the map without a title, and keep the result so that it can be reused for other titles
+                        ax.set_title('', fontsize='x-large')
+                        fig.canvas.draw()
+                        background = fig.canvas.copy_from_bbox(fig.bbox)
+
+                        last_signature = signature
+                        if index == key:
+                            rendered += 1
+                        else:
+                            rescaled += 1
+
+                    ax.title.set_text(f'Confirmed Cases - {all_dates[key].date()}')
+                    ax.draw_artist(ax.title)
+
+                    img = self.get_canvas_image(fig)
+
+                    if crop is None:
+                        # Crop to the map, its labels and colorbar, whose shape depends on the aspect ratio of the region
+                        crop = self.get_figure_crop(fig, pad=10)
+                        title_strip = self.get_title_strip(fig, crop)
+                    images.append(img[crop[0]:crop[1], crop[2]:crop[3]])
+
+                start_img, img = images[0], images[-1]
+
+                if video_writer is None:
+                    height, width, _ = img.shape
+                    size = (width, height)
+
+                    video_writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'DIVX'), fps, size)
+
+                for step in range(1, steps if k > 0 else 0):
+                    fraction = step/steps
+
+                    # Label the frame with the nearest date of the data, which repeats if there are more frames than dates
+                    date = all_dates[previous + int(fraction*(key-previous) + 0.5)]
+
+                    # Blend the two key date renders, then paste in a freshly drawn title for this date
+                    blended = cv2.addWeighted(start_img, 1-fraction, img, fraction, 0)
+
+                    fig.canvas.restore_region(background)
+                    ax.title.set_text(f'Confirmed Cases - {date.date()}')
+                    ax.draw_artist(ax.title)
+
+                    titled = self.get_canvas_image(fig)[crop[0]:crop[1], crop[2]:crop[3]]
+                    blended[title_strip] = titled[title_strip]
+
+                    video_writer.write(blended)
+                    written += 1
+
+                video_writer.write(img)
+                written += 1
+
+                progress.add(1, maximum=len(key_indices))
+
+        print(f'rendered {rendered} of {len(key_indices)} key dates ({rescaled} more on the color scale of the next), '
+              f'wrote {written} frames for {len(all_dates)} dates..', flush=True, end=' ')
+
+        video_writer.release()
+        return filename
+
+    @staticmethod
+    def get_canvas_image(fig):
+        """
+        :param fig: A figure which has already been drawn
+
+        :type fig: matplotlib.figure.Figure
+
+        :returns: The pixels of the figure, in the BGR channel order used by cv2
+        :rtype: np.ndarray
+        """
+
+        import numpy as np
+        import cv2
+
+        img = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep='')
+        img = img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+    @staticmethod
+    def get_title_strip(fig, crop):
+        """
+        :param fig: A figure which has already been drawn, with its title
+        :param crop: The (top, bottom, left, right) pixel rows and columns the figure image is cropped to
+
+        :type fig: matplotlib.figure.Figure
+        :type crop: (int, int, int, int)
+
+        :returns: Slices of the cropped image above the map, which hold the title and nothing that changes color
+        :rtype: (slice, slice)
+        """
+
+        renderer = fig.canvas.get_renderer()
+        _, height = fig.canvas.get_width_height()
+        ax = fig.axes[0]
+        box = ax.get_window_extent(renderer)
+        title_box = ax.title.get_window_extent(renderer)
+
+        # Leave out the colorbar beside the map where possible, since its tick labels may reach above the top of the map
+        # (a few pixels are added around the title, in case other dates are drawn slightly wider)
+        top = max(int(height-box.y1)-crop[0], 0)
+        left = max(int(min(box.x0, title_box.x0-4))-crop[2], 0)
+        right = max(int(max(box.x1, title_box.x1+4))-crop[2], 0)
+
+        return slice(0, top), slice(left, right)
+
+    def get_key_values(self, locations_per_level, date_step=1, max_change=None):
+        """ Chooses the key dates whose data is read, and reads it. The first and last dates are always key dates.
+
+        :param locations_per_level: A dictionary mapping levels to the locations plotted at that level of granularity
+        :param date_step: Every Nth date is a key date, defaults to 1
+        :param max_change: If given, any date where some location changed by at least this much since the last key date,
+                           in orders of magnitude, is also a key date, defaults to None
+
+        :type locations_per_level: {int:[str]}
+        :type date_step: int, optional
+        :type max_change: float|None, optional
+
+        :returns: A dictionary mapping the indices of key dates to their plotted values, see get_plotted_values
+        :rtype: {int:{int:pd.Series}}
+
+        :raises: ValueError
+        """
+
+        import numpy as np
+
+        if date_step < 1:
+            raise ValueError(f'unexpected date_step={date_step}')
+
+        all_dates = self.dataset.all_dates
+        last = len(all_dates)-1
+
+        key_values = {0: self.get_plotted_values(all_dates[0], locations_per_level)}
+        previous = 0
+
+        for i in range(1, last+1):
+            if i-previous >= date_step or i == last:
+                key_values[i] = self.get_plotted_values(all_dates[i], locations_per_level)
+                previous = i
+
+            elif max_change is not None:
+                values = self.get_plotted_values(all_dates[i], locations_per_level)
+
+                # Compare on a log scale, the same scale the colors are drawn with
+                change = max(np.abs(np.log10(1+values[lvl].values) - np.log10(1+key_values[previous][lvl].values)).max()
+                             for lvl in values)
+                if change >= max_change:
+                    key_values[i] = values
+                    previous = i
+
+        return key_values
+
+    def get_plotted_values(self, date, locations_per_level, target='Confirmed'):
+        """
+        :param date: Timestamp at which to get data
+        :param locations_per_level: A dictionary mapping levels to the locations plotted at that level of granularity
+        :param target: The target column to get data from, defaults to 'Confirmed'
+
+        :type date: datetime.datetime
+        :type locations_per_level: {int:[str]}
+        :type target: str, optional
+
+        :returns: A dictionary mapping levels to the value of each plotted location at that level
+        :rtype: {int:pd.Series}
+        """
+
+        return {lvl: self.dataset.get_datapoints(locations=locations, date=date, level=lvl, target=target)[target]
+                for lvl, locations in locations_per_level.items()}
+
+    def get_frame_signature(self, values_per_level, maximum=None):
+        """ Summarizes everything about the plotted values which affects how their frame is drawn.
+
+        :param values_per_level: A dictionary mapping levels to the value of each plotted location at that level
+        :param maximum: The colorbar maximum. Will use the largest value at level 0 if None, defaults to None
+
+        :type values_per_level: {int:pd.Series}
+        :type maximum: float|None, optional
+
+        :returns: The colorbar maximum and the colors of every plotted location, as bytes which are equal
+                  only if the drawn frames would be equal
+        :rtype: bytes
+        """
+
+        import numpy as np
+
+        if maximum is None:
+            maximum = values_per_level[0].max()
+        colors = self.get_colormap(maximum)
+
+        return np.concatenate([[maximum]] + [colors.to_rgba(values_per_level[lvl].values).ravel()
+                                             for lvl in sorted(values_per_level)]).tobytes()
+
+    @staticmethod
+    def get_colormap(maximum):
+        """
+        :param maximum: The largest value which will be drawn
+
+        :type maximum: float
+
+        :returns: A logarithmic colormap from 1 to the maximum value (or to 1, if nothing drawn is above 1)
+        :rtype: matplotlib.cm.ScalarMappable
+        """
+
+        import matplotlib.colors as plt_colors
+        import matplotlib.cm as cm
+        import copy
+
+        # Set up a colormap with logarithmic scale
+        # (a region may have no cases yet, and the norm cannot have a maximum below its minimum)
+        colors = cm.ScalarMappable(norm=plt_colors.LogNorm(vmin=1, vmax=maximum if maximum > 1 else 1), cmap='Reds')
+
+        # Copy the colormap before changing it, as it may be the instance shared by all of matplotlib
+        cmap = copy.copy(colors.get_cmap())
+        cmap.set_bad(cmap(0))
+        colors.set_cmap(cmap)
+
+        return colors
+
+    @staticmethod
+    def get_figure_crop(fig, pad=0):
+        """
+        :param fig: A figure which has already been drawn
+        :param pad: Number of pixels to keep around the drawn axes, defaults to 0
+
+        :type fig: matplotlib.figure.Figure
+        :type pad: int, optional
+
+        :returns: The (top, bottom, left, right) pixel rows and columns bounding all axes of the figure
+        :rtype: (int, int, int, int)
+        """
+
+        renderer = fig.canvas.get_renderer()
+        width, height = fig.canvas.get_width_height()
+
+        boxes = [ax.get_tightbbox(renderer) for ax in fig.axes]
+        x0 = min(box.x0 for box in boxes)
+        x1 = max(box.x1 for box in boxes)
+        y0 = min(box.y0 for box in boxes)
+        y1 = max(box.y1 for box in boxes)
+
+        # Display coordinates start at the bottom of the figure, while image rows start at the top
+        top = max(int(height-y1)-pad, 0)
+        bottom = min(int(height-y0)+pad, height)
+        left = max(int(x0)-pad, 0)
+        right = min(int(x1)+pad, width)
+
+        return top, bottom, left, right
+
+    def plot_data_as_world_colors(self, date=None, level=0):
+        """
+        :param date: Timestamp at which to plot data. Will use current time if None, defaults to None
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
+
+        :type date: datetime.datetime|None, optional
+        :type level: int, optional
+
+        :returns: A dictionary mapping levels to the plotted data at that level of granularity
+                  and a new map figure on which geographical data was drawn
+        :rtype: ({int:pd.DataFrame}, matplotlib.figure.Figure)
+        """
+
+        frame = self.draw_frame(date=date, level=level)
+        return frame.plotted_data, frame.figure
+
+    def draw_frame(self, date=None, level=0):
+        """
+        :param date: Timestamp at which to plot data. Will use current time if None, defaults to None
+        :param level: Granularity of world data, higher is more detail. Either 0 or 1, defaults to 0
+
+        :type date: datetime.datetime|None, optional
+        :type level: int, optional
+
+        :returns: A new map figure on which geographical data was drawn, which can be recolored for other values
+        :rtype: MapFrame
+        """
+
+        from mpl_toolkits.axes_grid1 import make_axes_locatable
+        from matplotlib.collections import PatchCollection
+
+        dataset = self.dataset
+
+        fig = self.create_figure()
+        ax = fig.axes[0]
+        ax.set_facecolor("#5D9BFF")
+
+        ##############################
+        # If you need to manually check all location fix possibilities for a given location, uncomment the following:
+
+        # debug_location = 'Nunavut'
+        # search_for_location_fix(self.get_layer(level), debug_location, None)
+        # sys.exit(0)
+
+        # You may also let the program search for and automatically print potential location fixes by setting the following
+        debug_new_location_fixes = False
+        ##############################
+
+        maximum = 0
+        colors = None
+
+        plotted_data_per_level = {}
+        collections_per_level = {}
+
+        # Work up to highest granularity
+        for lvl in range(level+1):
+            _, info_keys = shape_levels[lvl]
+            locations = dataset.get_locations(lvl)
+            layer = self.get_layer(lvl)
+
+            shape_map, empty_patches = get_location_to_shape_mapping(layer, locations, info_keys, dataset.rev_location_fixes,
+                                                                     visible=self.get_visible_shapes(lvl))
+            patches = get_drawable_patches(layer, locations, shape_map, info_keys, dataset.location_fixes,
+                                           debug_new_location_fixes=debug_new_location_fixes,
+                                           index=layer.get_info_index() if debug_new_location_fixes else None)
+
+            # Track what data is being plotted
+            plotted_data_per_level[lvl] = dataset.get_datapoints(locations=patches.keys(), date=date, level=lvl)
+            collections_per_level[lvl] = {}
+
+            if lvl == 0:
+                # Store the polygons of locations which do not correspond with data
+                patches[None] = empty_patches
+
+                maximum = plotted_data_per_level[lvl]['Confirmed'].max()
+                colors = self.get_colormap(maximum)
+
+            # Draw shapes with color according to associated location data
+            for k, v in patches.items():
+                if v:
+                    if k is None:
+                        # Color unknown locations black
+                        facecolor = 'k'
+                        zorder = 2  # Make sure unknown locations are drawn behind known locations, in case of overlap
+
+                    else:
+                        # Change color based on data value
+                        value = plotted_data_per_level[lvl].loc[k]
+                        facecolor = colors.to_rgba(value)
+                        zorder = 3 + lvl  # Make sure higher granularity is on top
+
+                    collection = PatchCollection(v, facecolor=facecolor, edgecolor='k', linewidths=0.2, zorder=zorder)
+                    ax.add_collection(collection)
+
+                    if k is not None:
+                        collections_per_level[lvl][k] = collection
+
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="5%", pad=0.02)
+        colorbar = fig.colorbar(colors, cax=cax)
+
+        return MapFrame(fig, plotted_data_per_level, collections_per_level, colorbar)
+
+
+class MapFrame:
+    """
+    A figure drawn by RenderContext.draw_frame, along with its colored shapes, so it can be recolored without rebuilding.
+    """
+
+    def __init__(self, figure, plotted_data, collections, colorbar):
+        """
+        :param figure: The map figure on which geographical data was drawn
+        :param plotted_data: A dictionary mapping levels to the plotted data at that level of granularity
+        :param collections: A dictionary mapping levels to the drawn shapes of each location at that level
+        :param colorbar: The colorbar of the map
+
+        :type figure: matplotlib.figure.Figure
+        :type plotted_data: {int:pd.DataFrame}
+        :type collections: {int:{str:matplotlib.collections.PatchCollection}}
+        :type colorbar: matplotlib.colorbar.Colorbar
+        """
+
+        self.figure = figure
+        self.plotted_data = plotted_data
+        self.collections = collections
+        self.colorbar = colorbar
+
+    def recolor(self, values_per_level, maximum=None):
+        """
+        :param values_per_level: A dictionary mapping levels to the value of each plotted location at that level
+        :param maximum: The colorbar maximum. Will use the largest value at level 0 if None, defaults to None
+
+        :type values_per_level: {int:pd.Series}
+        :type maximum: float|None, optional
+        """
+
+        if maximum is None:
+            maximum = values_per_level[0].max()
+        colors = RenderContext.get_colormap(maximum)
+
+        for lvl, collections in self.collections.items():
+            for location, collection in collections.items():
+                collection.set_facecolor(colors.to_rgba(values_per_level[lvl].loc[location]))
+
+        # Rescale the colorbar to the new maximum
+        self.colorbar.mappable.set_norm(colors.norm)
+        self.colorbar.update_normal(self.colorbar.mappable)
@@ -28,3 +28,42 @@ def benchmark_timing(description, func, *args, **kwargs):
     print(f"{end-start:0.4f}s", flush=True)
 
     return ret
+
+
+def benchmark_import(module, budget=None):
+    """ Imports a module in a fresh interpreter and prints how long the import took
+
+    :param module: Name of the module to import (e.g. 'project.main')
+    :param budget: Maximum allowed import time in seconds. Will not be checked if None, defaults to None
+
+    :type module: str
+    :type budget: float|None, optional
+
+    :returns: The measured import time in seconds
+    :rtype: float
+
+    :raises: RuntimeError
+    """
+
+    import subprocess
+    import sys
+
+    # Time the import from inside the child interpreter, so interpreter startup itself is not counted
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    elapsed = float(output.strip().splitlines()[-1])
+
+    print(f"Importing {module}.. {elapsed:0.4f}s", flush=True)
+
+    if budget is not None and elapsed > budget:
+        raise RuntimeError(f'importing {module} took {elapsed:0.4f}s, exceeding budget of {budget:0.4f}s')
+
+    return elapsed
+
+
+if __name__ == '__main__':
+
+    # Enforce the import-time budget of the modules on the startup path, so heavy imports don't creep back
+    _import_budget = 0.1  # seconds
+    for _module in ['project.main', 'project.covid_data', 'project.world_shapes', 'project.prediction']:
+        benchmark_import(_module, budget=_import_budget)
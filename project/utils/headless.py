@@ -0,0 +1,24 @@
+"""
+by Keelin Becker-Wheeler, Apr 2020
+"""
+
+_backend_forced = False
+
+
+def import_pyplot():
+    """ Imports pyplot on first use, forcing the non-interactive Agg backend for headless rendering
+
+    :returns: The matplotlib.pyplot module
+    """
+
+    global _backend_forced
+
+    import matplotlib
+
+    if not _backend_forced:
+        # Only force the backend once, since switching backends later would close any open figures
+        matplotlib.use('Agg')
+        _backend_forced = True
+
+    import matplotlib.pyplot as plt
+    return plt
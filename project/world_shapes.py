@@ -2,66 +2,194 @@
 by Keelin Becker-Wheeler, Apr 2020
 """
 
-from mpl_toolkits.basemap import Basemap
-from matplotlib.patches import Polygon
+import unicodedata
+import math
+import sys
+import re
 
-import numpy as np
+# Note: Basemap, matplotlib and numpy are imported where needed to keep startup fast
 
-import sys
+# Named map extents, as (min longitude, min latitude, max longitude, max latitude)
+regions = {
+    'world': (-180, -60, 180, 90),
+    'africa': (-20, -37, 55, 38),
+    'asia': (25, -12, 150, 60),
+    'europe': (-25, 34, 45, 72),
+    'north_america': (-170, 5, -50, 75),
+    'oceania': (110, -50, 180, 0),
+    'south_america': (-90, -57, -30, 15),
+}
 
 
-def create_world_map(ax, fill_color=True, draw_borders=True):
+def get_region_bounds(region=None):
     """
-    :param ax: Axes on which to draw map
+    :param region: A name from regions, or a (min longitude, min latitude, max longitude, max latitude) tuple.
+                   Will use the whole world if None, defaults to None
+
+    :type region: str|(float, float, float, float)|None, optional
+
+    :returns: The (min longitude, min latitude, max longitude, max latitude) extent of the region
+    :rtype: (float, float, float, float)
+
+    :raises: ValueError
+    """
+
+    if region is None:
+        region = 'world'
+
+    if isinstance(region, str):
+        if region not in regions:
+            raise ValueError(f'unexpected region={region}')
+        return regions[region]
+
+    if len(region) != 4:
+        raise ValueError(f'unexpected region={region}')
+
+    lon_min, lat_min, lon_max, lat_max = region
+    if not (-180 <= lon_min < lon_max <= 180 and -90 <= lat_min < lat_max <= 90):
+        raise ValueError(f'unexpected region={region}')
+
+    return tuple(region)
+
+
+# Shapefile name and keys used to get location names from its shape info, for each level of granularity
+shape_levels = {
+    0: ('ne_10m_admin_0_countries', ['NAME_SORT', 'SOVEREIGNT']),
+    1: ('ne_10m_admin_1_states_provinces', ['name', 'admin']),
+}
+
+
+def create_world_map(ax, fill_color=True, draw_borders=True, bounds=None):
+    """
+    :param ax: Axes on which to draw map. Nothing will be drawn if None
     :param fill_color: Whether to fill the graph with color, defaults to True
     :param draw_borders: Whether to draw state/country borders, defaults to True
+    :param bounds: The (min longitude, min latitude, max longitude, max latitude) extent of the map.
+                   Will use the whole world if None, defaults to None
 
-    :type ax: matplotlib.axes.Axes
+    :type ax: matplotlib.axes.Axes|None
     :type fill_color: bool, optional
     :type draw_borders: bool, optional
+    :type bounds: (float, float, float, float)|None, optional
 
     :rtype: Basemap
     """
 
+    from mpl_toolkits.basemap import Basemap
+
+    if bounds is None:
+        bounds = regions['world']
+    lon_min, lat_min, lon_max, lat_max = bounds
+
+    # Coastline and border data is only needed (and loaded) if filling or drawing borders
+    resolution = 'c' if fill_color or draw_borders else None
+
     # Create a map projection space in order to display nodes at geographical positions
-    m = Basemap(projection='gall', resolution='c', llcrnrlat=-60, urcrnrlat=90,
-                llcrnrlon=-180, urcrnrlon=180, ax=ax)
+    m = Basemap(projection='gall', resolution=resolution, llcrnrlat=lat_min, urcrnrlat=lat_max,
+                llcrnrlon=lon_min, urcrnrlon=lon_max, ax=ax)
 
-    m.drawparallels(np.arange(-90, 90, 30), labels=[1, 0, 0, 0])
-    m.drawmeridians(np.arange(m.lonmin, m.lonmax+30, 60), labels=[0, 0, 0, 1])
+    if ax is not None:
+        draw_world_map(m, ax, fill_color=fill_color, draw_borders=draw_borders)
+
+    return m
+
+
+def draw_world_map(m, ax, fill_color=True, draw_borders=True):
+    """ Draws the map background of an existing basemap on the given axes, which may differ from the map's own axes
+
+    :param m: The world basemap
+    :param ax: Axes on which to draw map
+    :param fill_color: Whether to fill the graph with color, defaults to True
+    :param draw_borders: Whether to draw state/country borders, defaults to True
+
+    :type m: Basemap
+    :type ax: matplotlib.axes.Axes
+    :type fill_color: bool, optional
+    :type draw_borders: bool, optional
+    """
+
+    import numpy as np
+
+    # Use coarser grid lines for larger extents
+    parallel_step = 30 if m.latmax-m.latmin > 90 else 10
+    meridian_step = 60 if m.lonmax-m.lonmin > 180 else 20
+    m.drawparallels(np.arange(-90, 90, parallel_step), labels=[1, 0, 0, 0], ax=ax)
+    m.drawmeridians(np.arange(m.lonmin, m.lonmax+meridian_step, meridian_step), labels=[0, 0, 0, 1], ax=ax)
 
     if fill_color:
-        m.fillcontinents(color="#0D9C29", lake_color="#5D9BFF", zorder=0)
+        m.fillcontinents(color="#0D9C29", lake_color="#5D9BFF", zorder=0, ax=ax)
     if draw_borders:
-        m.drawmapboundary(fill_color="#5D9BFF" if fill_color else None, zorder=-1)
-        m.drawcountries(color='#585858', linewidth=1)
-        m.drawstates(linewidth=0.2)
-        m.drawcoastlines(linewidth=1)
+        m.drawmapboundary(fill_color="#5D9BFF" if fill_color else None, zorder=-1, ax=ax)
+        m.drawcountries(color='#585858', linewidth=1, ax=ax)
+        m.drawstates(linewidth=0.2, ax=ax)
+        m.drawcoastlines(linewidth=1, ax=ax)
 
-    return m
+    m.set_axes_limits(ax=ax)
 
 
-def get_drawable_patches(m, locations, shape_map, info_keys, location_fixes, debug_new_location_fixes=False):
+class ShapeLayer:
     """
-    :param m: The world basemap
+    The shapes and shape info of one shapefile, projected onto a world basemap.
+    Kept separately from the basemap, so that several shapefiles can be loaded onto the same map.
+    """
+
+    def __init__(self, m, shape_path):
+        """
+        :param m: The world basemap onto which shapes are projected
+        :param shape_path: Path to the shapefile, without extension
+
+        :type m: Basemap
+        :type shape_path: str
+        """
+
+        m.readshapefile(shape_path, 'shapes', drawbounds=False)
+
+        self.shapes_info = m.shapes_info
+        self.shapes = m.shapes
+
+        self.info_index = None
+
+    def get_info_index(self):
+        """
+        :returns: An index over the shape info of the layer, built on first use and then reused
+        :rtype: ShapeInfoIndex
+        """
+
+        if self.info_index is None:
+            self.info_index = ShapeInfoIndex(self.shapes_info)
+
+        return self.info_index
+
+
+def get_drawable_patches(m, locations, shape_map, info_keys, location_fixes, debug_new_location_fixes=False,
+                         index=None):
+    """
+    :param m: The world basemap, or a shape layer loaded onto it
     :param locations: A list of location names associated with data of interest
     :param shape_map: A dictionary mapping all locations from the shape info to lists of shape data
     :param info_keys: List of keys used to get location names from the shape info data
     :param location_fixes: A mapping of names in the list of locations to corrected shape info location names
     :param debug_new_location_fixes: If True will search for and print fixes for name inconsistencies, defaults to False
+    :param index: A prebuilt index of the shape info used to search for fixes. Will be built from m if None,
+                  defaults to None
 
-    :type m: Basemap
+    :type m: Basemap|ShapeLayer
     :type locations: [str]
     :type shape_map: {str:[Basemap.shape]}
     :type info_keys: [str]
     :type location_fixes: {str:str}
     :type debug_new_location_fixes: bool, optional
+    :type index: ShapeInfoIndex|None, optional
 
     :returns: A dictionary mapping names of locations from the list given to drawable polygons
     :rtype: {str:[Polygon]}
     """
 
+    from matplotlib.patches import Polygon
+    import numpy as np
+
     patches = {}
+    missing = []
 
     # Find drawable polygons for each location with data
     for location in sorted(locations):
@@ -85,43 +213,52 @@ def get_drawable_patches(m, locations, shape_map, info_keys, location_fixes, deb
             # The location name in the given list is not found in the available shape locations
 
             if debug_new_location_fixes:
-                # Search for and print potential fixes for the location name inconsistencies (not guaranteed fixes)
-                search_for_location_fix(m, location, info_keys, automated_mode=True)
+                # Collect the location so that potential fixes can be searched for all at once
+                missing.append(location)
 
             else:
                 raise e
 
         finally:
-            if shapes is not None:
-                # Add shapes to be drawn
+            if shapes:
+                # Add shapes to be drawn (locations without any visible shapes are skipped)
                 patches[location] = []
                 for shape in shapes:
                     patches[location].append(Polygon(np.array(shape), True))
 
+    if missing:
+        # Search for and print potential fixes for the location name inconsistencies (not guaranteed fixes)
+        print_location_fixes(resolve_location_fixes(m, missing, info_keys, index=index))
+
     return patches
 
 
-def get_location_to_shape_mapping(m, known_locations, info_keys, rev_location_fixes):
+def get_location_to_shape_mapping(m, known_locations, info_keys, rev_location_fixes, visible=None):
     """
-    :param m: The world basemap
+    :param m: The world basemap, or a shape layer loaded onto it
     :param known_locations: A list of location names associated with data of interest
     :param info_keys: List of keys used to get location names from the shape info data
     :param rev_location_fixes: A mapping of corrected shape info location names to names in the known locations
+    :param visible: Indices of the shapes which are inside the viewport. Will use all shapes if None, defaults to None
 
-    :type m: Basemap
+    :type m: Basemap|ShapeLayer
     :type known_locations: [str]
     :type info_keys: [str]
     :type rev_location_fixes: {str:str}
+    :type visible: {int}|None, optional
 
     :returns: A dictionary mapping all locations from the shape info to lists of shape data,
               and a list of drawable Polygons corresponding to locations from the shape info that are not known locations
     :rtype: ({str:[Basemap.shape]}, [Polygon])
     """
 
+    from matplotlib.patches import Polygon
+    import numpy as np
+
     empty_patches = []
     shape_map = {None: None}
 
-    for info, shape in zip(m.shapes_info, m.shapes):
+    for i, (info, shape) in enumerate(zip(m.shapes_info, m.shapes)):
         # Add shape to map
         seen = set()
         for info_key in info_keys:
@@ -131,6 +268,10 @@ def get_location_to_shape_mapping(m, known_locations, info_keys, rev_location_fi
 
             if info[info_key] not in shape_map:
                 shape_map[info[info_key]] = []
+
+            if visible is not None and i not in visible:
+                # Keep the location name known, but skip shapes outside the viewport
+                continue
             shape_map[info[info_key]].append(shape)
 
             # Add shape to empty_patches if not associated with data
@@ -145,12 +286,12 @@ def get_location_to_shape_mapping(m, known_locations, info_keys, rev_location_fi
 
 def search_for_location_fix(m, location, info_keys, automated_mode=False):
     """
-    :param m: The world basemap
+    :param m: The world basemap, or a shape layer loaded onto it
     :param location: A location name to inspect
     :param info_keys: List of keys used to get location names from the shape info data
     :param automated_mode: If True will print the first found mapping, else will print all shape info, defaults to False
 
-    :type m: Basemap
+    :type m: Basemap|ShapeLayer
     :type location: str
     :type info_keys: [str]
     :type automated_mode: bool, optional
@@ -180,3 +321,275 @@ def search_for_location_fix(m, location, info_keys, automated_mode=False):
             for k, v in info.items():
                 sys.stdout.buffer.write(f'{k}: {v}\n'.encode('utf-8'))
             print('------------------------------------------', flush=True)
+
+
+class ShapeInfoIndex:
+    """
+    Inverted index of normalized tokens and character n-grams over every string attribute of the shape info,
+    used to rank candidate shape names for many unmatched location names at once.
+    """
+
+    def __init__(self, shapes_info, ngram_size=3):
+        """
+        :param shapes_info: The shape info records, as found on the world basemap after reading a shapefile
+        :param ngram_size: Number of characters in each indexed n-gram, defaults to 3
+
+        :type shapes_info: [{str:object}]
+        :type ngram_size: int, optional
+        """
+
+        self.shapes_info = shapes_info
+        self.ngram_size = ngram_size
+
+        # Each indexed document is a single (record, attribute) pair, so n-grams from unrelated fields are not combined
+        self.documents = []
+        self.exact = {}
+        self.postings = {}
+
+        for i, info in enumerate(shapes_info):
+            for k, v in info.items():
+                if not isinstance(v, str):
+                    continue
+
+                normalized = normalize_location_name(v)
+                if not normalized:
+                    continue
+
+                doc = len(self.documents)
+                self.documents.append((i, k))
+                self.exact.setdefault(normalized, set()).add(doc)
+
+                for gram in self.get_ngrams(normalized):
+                    self.postings.setdefault(gram, set()).add(doc)
+
+        # Rare n-grams are more telling than common ones (e.g. from 'island' or 'province')
+        self.weights = {gram: math.log(1 + len(self.documents)/len(docs)) for gram, docs in self.postings.items()}
+
+    def get_ngrams(self, normalized):
+        """
+        :param normalized: A normalized location name
+
+        :type normalized: str
+
+        :returns: The set of padded character n-grams of every token in the name
+        :rtype: {str}
+        """
+
+        grams = set()
+        for token in normalized.split():
+            padded = f' {token} '
+            for i in range(max(1, len(padded)-self.ngram_size+1)):
+                grams.add(padded[i:i+self.ngram_size])
+        return grams
+
+    def search(self, location, limit=5):
+        """
+        :param location: A location name to find candidate shape info records for
+        :param limit: Maximum number of candidates to return, defaults to 5
+
+        :type location: str
+        :type limit: int, optional
+
+        :returns: Pairs of shape info record index and score in [0, 1], best match first
+        :rtype: [(int, float)]
+        """
+
+        normalized = normalize_location_name(location)
+        grams = self.get_ngrams(normalized)
+
+        # N-grams missing from the shape info count as rarest, so they still lower the score
+        unseen_weight = math.log(1 + len(self.documents))
+        total = sum(self.weights.get(gram, unseen_weight) for gram in grams)
+
+        scores = {}
+        if total > 0:
+            for gram in grams:
+                for doc in self.postings.get(gram, ()):
+                    scores[doc] = scores.get(doc, 0) + self.weights[gram]/total
+
+        # An exact match on the normalized name always ranks first
+        for doc in self.exact.get(normalized, ()):
+            scores[doc] = 1 + scores.get(doc, 0)
+
+        # Keep the best scoring attribute of each record
+        best = {}
+        for doc, score in scores.items():
+            i, _ = self.documents[doc]
+            best[i] = max(best.get(i, 0), min(score, 1))
+
+        return sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def normalize_location_name(name):
+    """
+    :param name: A location name
+
+    :type name: str
+
+    :returns: The name with accents removed, lower case, and punctuation collapsed into single spaces
+    :rtype: str
+    """
+
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.lower()).split())
+
+
+def find_unmatched_locations(locations, shape_map, location_fixes):
+    """
+    :param locations: A list of location names associated with data of interest
+    :param shape_map: A dictionary mapping all locations from the shape info to lists of shape data
+    :param location_fixes: A mapping of names in the list of locations to corrected shape info location names
+
+    :type locations: [str]
+    :type shape_map: {str:[Basemap.shape]}
+    :type location_fixes: {str:str}
+
+    :returns: The sorted location names which have no shapes and no existing location fix
+    :rtype: [str]
+    """
+
+    return sorted(location for location in set(locations)
+                  if location and location not in shape_map and location not in location_fixes)
+
+
+def resolve_location_fixes(m, locations, info_keys, index=None, min_score=0.5):
+    """
+    :param m: The world basemap, or a shape layer loaded onto it
+    :param locations: A list of unmatched location names to propose fixes for
+    :param info_keys: List of keys used to get location names from the shape info data
+    :param index: A prebuilt index of the shape info. Will be built from m if None, defaults to None
+    :param min_score: Minimum score for a candidate to be proposed, defaults to 0.5
+
+    :type m: Basemap|ShapeLayer
+    :type locations: [str]
+    :type info_keys: [str]
+    :type index: ShapeInfoIndex|None, optional
+    :type min_score: float, optional
+
+    :returns: A proposed location fix table, mapping each location to a shape info location name or None if unresolved
+    :rtype: {str:str}
+    """
+
+    if index is None:
+        index = ShapeInfoIndex(m.shapes_info)
+
+    fixes = {}
+    for location in sorted(locations):
+        fixes[location] = None
+        for i, score in index.search(location, limit=1):
+            if score >= min_score:
+                fixes[location] = index.shapes_info[i][info_keys[0]]
+
+    return fixes
+
+
+def print_location_fixes(fixes):
+    """ Prints a proposed location fix table in the format of CovidDataset.location_fixes
+
+    :param fixes: A mapping of location names to proposed shape info location names
+
+    :type fixes: {str:str}
+    """
+
+    for location, fix in sorted(fixes.items()):
+        fix = 'None' if fix is None else repr(fix)
+        sys.stdout.buffer.write(f'{location!r}: {fix},'.encode('utf-8'))
+        print(flush=True)
+
+
+class ShapeBoundsIndex:
+    """
+    Uniform grid over the bounding boxes of the shapes, used to quickly find the shapes inside a viewport.
+    """
+
+    def __init__(self, shapes, grid_size=64):
+        """
+        :param shapes: The shape data, as found on the world basemap after reading a shapefile
+        :param grid_size: Number of grid cells along each axis, defaults to 64
+
+        :type shapes: [Basemap.shape]
+        :type grid_size: int, optional
+        """
+
+        self.bounds = []
+        for shape in shapes:
+            xs, ys = zip(*shape)
+            self.bounds.append((min(xs), min(ys), max(xs), max(ys)))
+
+        self.grid_size = grid_size
+        self.cells = {}
+
+        if not self.bounds:
+            return
+
+        x0s, y0s, x1s, y1s = zip(*self.bounds)
+        self.extent = (min(x0s), min(y0s), max(x1s), max(y1s))
+
+        # Register each shape in every cell its bounding box overlaps
+        for i, bounds in enumerate(self.bounds):
+            for cell in self.get_cells(bounds):
+                self.cells.setdefault(cell, []).append(i)
+
+    def get_cells(self, bounds):
+        """
+        :param bounds: A (min x, min y, max x, max y) box in map coordinates
+
+        :type bounds: (float, float, float, float)
+
+        :returns: The (column, row) grid cells which overlap the box
+        :rtype: [(int, int)]
+        """
+
+        x0, y0, x1, y1 = self.extent
+        width = (x1-x0) / self.grid_size or 1
+        height = (y1-y0) / self.grid_size or 1
+
+        def clamp(n):
+            return min(max(n, 0), self.grid_size-1)
+
+        cols = range(clamp(int((bounds[0]-x0) // width)), clamp(int((bounds[2]-x0) // width))+1)
+        rows = range(clamp(int((bounds[1]-y0) // height)), clamp(int((bounds[3]-y0) // height))+1)
+        return [(col, row) for col in cols for row in rows]
+
+    def query(self, viewport):
+        """
+        :param viewport: A (min x, min y, max x, max y) box in map coordinates
+
+        :type viewport: (float, float, float, float)
+
+        :returns: Indices of the shapes whose bounding boxes intersect the viewport
+        :rtype: {int}
+        """
+
+        if not self.bounds:
+            return set()
+
+        x0, y0, x1, y1 = self.extent
+        if viewport[2] < x0 or viewport[0] > x1 or viewport[3] < y0 or viewport[1] > y1:
+            return set()
+
+        visible = set()
+        for cell in self.get_cells(viewport):
+            for i in self.cells.get(cell, ()):
+                if i in visible:
+                    continue
+
+                bx0, by0, bx1, by1 = self.bounds[i]
+                if bx0 <= viewport[2] and bx1 >= viewport[0] and by0 <= viewport[3] and by1 >= viewport[1]:
+                    visible.add(i)
+
+        return visible
+
+
+def get_map_viewport(m):
+    """
+    :param m: The world basemap
+
+    :type m: Basemap
+
+    :returns: The (min x, min y, max x, max y) box of the visible map, in map coordinates
+    :rtype: (float, float, float, float)
+    """
+
+    return m.llcrnrx, m.llcrnry, m.urcrnrx, m.urcrnry
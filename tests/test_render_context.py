@@ -0,0 +1,160 @@
+"""
+by Keelin Becker-Wheeler, Apr 2020
+"""
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+shapefile = pytest.importorskip('shapefile')
+pytest.importorskip('cv2')
+pytest.importorskip('mpl_toolkits.basemap')
+
+from project.covid_data import CovidDataset  # noqa: E402
+from project.render_context import RenderContext  # noqa: E402
+
+
+def write_rectangles(path, fields, records):
+    """ Writes a shapefile with one rectangle per record
+
+    :type path: str
+    :type fields: [str]
+    :type records: [([str], (float, float, float, float))]
+    """
+
+    writer = shapefile.Writer(path, shapeType=shapefile.POLYGON)
+    for field in fields:
+        writer.field(field, 'C')
+
+    for names, (x0, y0, x1, y1) in records:
+        writer.poly([[(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]])
+        writer.record(*names)
+
+    writer.close()
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """ A small dataset where Europe has no confirmed cases on the first date, the number of cases in Canada grows
+    past the United States, and the United States stays constant
+    """
+
+    write_rectangles(str(tmp_path/'ne_10m_admin_0_countries'), ['NAME_SORT', 'SOVEREIGNT'], [
+        (['France', 'France'], (-5, 42, 8, 51)),
+        (['Canada', 'Canada'], (-140, 50, -60, 70)),
+        (['United States of America', 'United States of America'], (-125, 25, -70, 49)),
+    ])
+    write_rectangles(str(tmp_path/'ne_10m_admin_1_states_provinces'), ['name', 'admin'], [
+        (['Texas', 'United States of America'], (-106, 26, -94, 36)),
+    ])
+
+    dates = pd.date_range('2020-01-22', periods=3)
+
+    world = pd.DataFrame([(date, country, '', 0, 0, confirmed, 0, 0)
+                          for i, date in enumerate(dates)
+                          for country, confirmed in [('France', 0 if i < 2 else 4), ('Canada', 10**(i+1))]],
+                         columns=['Date', 'Country/Region', 'Province/State', 'Lat', 'Long',
+                                  'Confirmed', 'Recovered', 'Deaths'])
+    world.to_csv(tmp_path/'world.csv', index=False)
+
+    usa = pd.DataFrame([(1, 'US', 'USA', 840, 1, 'Harris', 'Texas', 'US', 0, 0, 'Harris', 1, date, 30, 1)
+                        for date in dates],
+                       columns=['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region',
+                                'Lat', 'Long_', 'Combined_Key', 'Population', 'Date', 'Confirmed', 'Deaths'])
+    usa.to_csv(tmp_path/'us.csv', index=False)
+
+    return CovidDataset(str(tmp_path/'world.csv'), str(tmp_path/'us.csv'))
+
+
+@pytest.fixture
+def written_frames(monkeypatch):
+    """ Records the frames written to videos in memory instead, since videos are compressed
+    """
+
+    import cv2
+
+    frames = []
+
+    class RecordingWriter:
+        def __init__(self, filename, fourcc, fps, size):
+            pass
+
+        def write(self, img):
+            frames.append(img.copy())
+
+        def release(self):
+            pass
+
+    monkeypatch.setattr(cv2, 'VideoWriter', RecordingWriter)
+    return frames
+
+
+def test_region_without_cases(dataset, tmp_path):
+    context = RenderContext(dataset, shape_folder=str(tmp_path), region='europe')
+
+    plotted_data, fig = context.plot_data_as_world_colors(date=dataset.all_dates[0])
+    fig.canvas.draw()
+
+    assert list(plotted_data[0].index) == ['France']
+    assert plotted_data[0]['Confirmed'].max() == 0
+
+    filename = context.plot_data_over_time(filename=str(tmp_path/'europe.avi'))
+    assert (tmp_path/'europe.avi').exists() and filename == str(tmp_path/'europe.avi')
+
+
+@pytest.mark.parametrize('frames_per_key, frames', [(None, 3), (1, 2), (4, 5)])
+def test_frames_between_key_dates(dataset, tmp_path, capsys, frames_per_key, frames):
+    import cv2
+
+    context = RenderContext(dataset, shape_folder=str(tmp_path))
+    filename = context.plot_data_over_time(filename=str(tmp_path/'world.avi'), date_step=2,
+                                           frames_per_key=frames_per_key)
+
+    # Only the first and last of the 3 dates are rendered, the other frames are blended
+    out = capsys.readouterr().out
+    assert 'rendered 2 of 2 key dates' in out and f'wrote {frames} frames for 3 dates' in out
+    assert int(cv2.VideoCapture(filename).get(cv2.CAP_PROP_FRAME_COUNT)) == frames
+
+
+def test_blended_frames_keep_color_scale(dataset, tmp_path, written_frames):
+    context = RenderContext(dataset, shape_folder=str(tmp_path))
+    context.plot_data_over_time(filename=str(tmp_path/'world.avi'), overwrite=True, date_step=2)
+
+    # The first and last dates are rendered, and the middle frame is blended between them
+    assert len(written_frames) == 3
+    first, blended, last = written_frames
+
+    # Find where the colorbar and the United States are in the cropped frames, from the same figure layout
+    fig = context.draw_frame(date=dataset.all_dates[0]).figure
+    ax = fig.axes[0]
+    ax.set_title(f'Confirmed Cases - {dataset.all_dates[0].date()}', fontsize='x-large')
+    fig.canvas.draw()
+
+    top, _, left, _ = RenderContext.get_figure_crop(fig, pad=10)
+    _, height = fig.canvas.get_width_height()
+    x, y = ax.transData.transform(context.world(-97, 37))
+    row, column = int(height-y)-top, int(x)-left
+    colorbar = int(ax.get_window_extent(fig.canvas.get_renderer()).x1)-left+1
+
+    # The colorbar of the blended frame is the same as the later key date, rather than a mix of two scales
+    assert (blended[:, colorbar:] == last[:, colorbar:]).all()
+    assert not (first[:, colorbar:] == last[:, colorbar:]).all()
+
+    # The United States has the same value at every date, so keeps its exact color on the later key date's scale
+    assert (blended[row, column] == last[row, column]).all()
+    assert not (first[row, column] == last[row, column]).all()
+
+
+def test_unchanged_dates_reuse_render(dataset, tmp_path, capsys, written_frames):
+    context = RenderContext(dataset, shape_folder=str(tmp_path), region='europe')
+
+    # France has 0 cases on the first two dates, so the second date only needs its title redrawn
+    context.plot_data_over_time(filename=str(tmp_path/'europe.avi'), overwrite=True, skip_unchanged=True)
+    assert 'rendered 2 of 3 key dates' in capsys.readouterr().out
+    reused = list(written_frames)
+
+    written_frames.clear()
+    context.plot_data_over_time(filename=str(tmp_path/'europe.avi'), overwrite=True, skip_unchanged=False)
+    assert 'rendered 3 of 3 key dates' in capsys.readouterr().out
+
+    assert len(reused) == len(written_frames) == 3
+    assert all((a == b).all() for a, b in zip(reused, written_frames))